@@ -9,19 +9,24 @@
 # Built-In Imports
 from __future__ import annotations
 
+import asyncio
+import functools
+import inspect
+import os
 import re
 import subprocess
 import sys
+import tempfile
 import warnings
 import logging
-from datetime import datetime
 from typing import List, Tuple, Optional
 
 # 3rd-Party Imports
 
 # Local Imports
 from .helpers import normalize_float, normalize_font_path, fix_ffmpeg_text
-from .types import Input, Output, Dimension, Position, Seconds, Volume
+from .probe import PROBE
+from .types import Input, Output, Dimension, Position, Seconds, Volume, FilterOp
 
 
 def get_logger(name, level=logging.DEBUG):
@@ -49,26 +54,60 @@ def get_logger(name, level=logging.DEBUG):
 
 logger = get_logger("FFMPEG")
 
+_OUTPUT_TAG_RE = re.compile(r'(\[\w*\];)')
+_INPUT_STREAM_RE = re.compile(r'^\d+(:|$)')  # Input stream specifiers, ex: 0, 0:a, 1:v:0
+_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
+
+# Placeholders replaced by FrozenFFMPEG when running a frozen command
+INPUT_PLACEHOLDER = '{INPUT}'
+OUTPUT_PLACEHOLDER = '{OUTPUT}'
+
+
+def _serialize_filter(filter_op: FilterOp) -> str:
+    """
+        Format a filter of the filter complex.
+    """
+
+    if not filter_op.kind:
+        # Custom filter complex, it is already formatted
+        return filter_op.params
+
+    inputs = ''.join(f'[{input}]' for input in filter_op.inputs)
+    outputs = ''.join(f'[{output}]' for output in filter_op.outputs)
+    params = f'={filter_op.params}' if filter_op.params else ''
+
+    return f'{inputs}{filter_op.kind}{params}{outputs};'
+
 
 class RoundFloats():
+    # Annotations of the parameters that can receive a float, as they are written in the
+    # decorated signatures (annotations are not evaluated in this module)
+    _FLOAT_ANNOTATIONS = {'float', 'Optional[float]', 'Dimension', 'Position', 'Seconds', 'Size', 'Volume'}
+
     def __init__(self, n_decimals: int = 2):
         self._n_decimals = n_decimals
 
     def __call__(self, function):
-        def wrapper(cls, *args, **kwargs):
-            return_args = []
-            for arg in args:
-                if isinstance(arg, float):
-                    arg = round(arg, self._n_decimals)
-                return_args.append(arg)
+        n_decimals = self._n_decimals
+
+        # Resolve once which parameters need rounding (index in *args, name in **kwargs),
+        # so each call only looks at those instead of every argument
+        parameters = list(inspect.signature(function).parameters.values())[1:]
+        float_parameters = tuple(
+            (index, parameter.name) for index, parameter in enumerate(parameters)
+            if parameter.annotation in self._FLOAT_ANNOTATIONS
+        )
 
-            return_kargs = {}
-            for key, arg in kwargs.items():
-                if isinstance(arg, float):
-                    arg = round(arg, self._n_decimals)
-                return_kargs[key] = arg
+        @functools.wraps(function)
+        def wrapper(cls, *args, **kwargs):
+            for index, name in float_parameters:
+                if index < len(args):
+                    if isinstance(args[index], float):
+                        args = args[:index] + (round(args[index], n_decimals),) + args[index + 1:]
+                elif isinstance(kwargs.get(name), float):
+                    kwargs[name] = round(kwargs[name], n_decimals)
 
-            return function(cls, *return_args, **return_kargs)
+            return function(cls, *args, **kwargs)
 
         return wrapper
 
@@ -77,12 +116,13 @@ class FFMPEG:
     """
         Interact with FFMPEG using python.
     """
-    _silent_audio_streams = {}  # Saves the silent audio streams for each duration, so it can be reused
 
     def __init__(self, ffmpeg_path: str = 'ffmpeg', use_gpu=False):
         self.ffmpeg_path = ffmpeg_path
 
         self._debug = True
+        self._use_gpu = use_gpu
+        self._probe: Optional[PROBE] = None
 
         # Set default values
         self._set_defaults()
@@ -114,18 +154,26 @@ class FFMPEG:
         """
 
         self.cmd = [self.ffmpeg_path]
-        self.filter_complex = []
+        self.filter_complex: List[FilterOp] = []
         self.maps = []
+        self.extra_output_options = []  # Encoder options not covered by the settings
 
         self._quality = '20'  # The lower, the better quality
         self._preset = 'slow'
         self._pix_format = None
+        self._threads = 0  # 0 lets ffmpeg pick the thread count
+        self._low_latency = False
         self._video_encoder = "h264_nvenc"
         self._audio_encoder = 'aac'
         self._bitrate = '44100'
         self._output_added = False
         self._overwrite_output = True
         self._input_count = 0
+        self._input_files = []
+        self._temp_files = []
+        self._gpu_streams = set()  # Streams whose frames live in GPU memory
+        self._silent_audio_count = 0  # Used to give every silent audio stream a unique label
+        self._transfer_count = 0
 
     def _compile_settings(self) -> List[str]:
 
@@ -146,6 +194,15 @@ class FFMPEG:
         if self._preset:
             settings.extend(['-preset', self._preset])
 
+        if self._low_latency and self._video_encoder == 'h264_nvenc':
+            # Don't hold frames back for lookahead, short segments finish sooner
+            settings.extend(['-rc-lookahead', '0', '-delay', '0'])
+
+        if self._threads is not None:
+            settings.extend(['-threads', str(self._threads)])
+
+        settings.extend(self.extra_output_options)
+
         if self._pix_format:
             settings.extend(['-pix_fmt', self._pix_format])
 
@@ -167,21 +224,18 @@ class FFMPEG:
             Compile the filter complex.
         """
 
-        commands = ''.join(self.filter_complex)
-        if commands.endswith(';'):
-            commands = commands[:-1]
+        commands = ''.join(_serialize_filter(filter_op) for filter_op in self.filter_complex)
 
-        return commands
+        return commands[:-1] if commands.endswith(';') else commands
 
     def _add_filter_complex(self) -> FFMPEG:
         """
             Add the filter complex to the command.
         """
 
-        if self.filter_complex:
-            commands = self._compile_filter_complex()
-            self.cmd.extend(['-filter_complex', commands])
-            self.cmd.extend(self.maps)
+        commands = self._compile_filter_complex()
+        if commands:
+            self.cmd += ['-filter_complex', commands, *self.maps]
         return self
 
     @property
@@ -211,6 +265,70 @@ class FFMPEG:
 
         self._quality = value
 
+    def stream_copy(self) -> FFMPEG:
+        """
+            Copy the streams to the output as they are, without decoding or encoding.
+
+            Settings only used by the encoders are cleared, reset() restores them.
+        """
+
+        self._video_encoder = 'copy'
+        self._audio_encoder = 'copy'
+        self._bitrate = None
+        self._quality = None
+        self._preset = None
+        self._pix_format = None
+        return self
+
+    @property
+    def preset(self) -> str:
+        """
+            Get the encoder preset.
+        """
+
+        return self._preset
+
+    @preset.setter
+    def preset(self, value: str) -> None:
+        """
+            Set the encoder preset.
+        """
+
+        self._preset = value
+
+    @property
+    def threads(self) -> Optional[int]:
+        """
+            Get the number of threads, 0 means automatic.
+        """
+
+        return self._threads
+
+    @threads.setter
+    def threads(self, value: Optional[int]) -> None:
+        """
+            Set the number of threads, 0 means automatic and None leaves it to the encoder default.
+        """
+
+        self._threads = value
+
+    @property
+    def low_latency(self) -> bool:
+        """
+            Get if NVENC encodes without lookahead and async depth.
+        """
+
+        return self._low_latency
+
+    @low_latency.setter
+    def low_latency(self, value: bool) -> None:
+        """
+            Set if NVENC encodes without lookahead and async depth. Short segments finish
+            sooner but long encodes lose throughput, since the CPU waits on every frame.
+        """
+
+        self._low_latency = value
+
     @property
     def audio_encoder(self) -> str:
         """
@@ -289,30 +407,90 @@ class FFMPEG:
             Useful when you want to run different commands under the same instance.
         """
 
+        # Temp files of a command that never ran would be forgotten otherwise
+        self._remove_temp_files()
         self._set_defaults()
 
         return self
 
     @RoundFloats()
-    def add_input(self, input_file: str, start_from: Optional[float] = None) -> FFMPEG:
+    def add_input(self, input_file: str, start_from: Optional[float] = None,
+                  input_options: Optional[List[str]] = None) -> FFMPEG:
         """
             Add an input file.
 
             @param input_file: The input file.
             @param start_from: Will make the video start from this time in seconds.
+            @param input_options: Extra options only for this input, added after the
+                extra_input_options.
         """
 
-        input_cmd = self.extra_input_options.copy()
+        self.cmd += self.extra_input_options
+        if input_options:
+            self.cmd += input_options
         if start_from:
             # There are some error as expected from cutting and also recording so to try to avoid it
             # we just add a couple milliseconds to the start time.
             start_from += .250
-            start_from = datetime.utcfromtimestamp(start_from).strftime('%H:%M:%S.%f')[:-3]
-            input_cmd.extend(['-ss', start_from, '-i', input_file])
+
+            # Format as HH:MM:SS.mmm
+            total_ms = int(round(start_from * 1000))
+            hours, rest = divmod(total_ms, 3_600_000)
+            minutes, rest = divmod(rest, 60_000)
+            seconds, milliseconds = divmod(rest, 1000)
+            start_from = f'{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}'
+            self.cmd += ['-ss', start_from, '-i', input_file]
         else:
-            input_cmd.extend(['-i', input_file])
+            self.cmd += ['-i', input_file]
 
-        self.cmd.extend(input_cmd)
+        self._input_files.append(input_file)
+        self._mark_input_on_gpu(input_file)
+        self._input_count += 1
+        return self
+
+    def add_concat_demuxer(self, input_files: List[str], list_path: Optional[str] = None,
+                           input_options: Optional[List[str]] = None) -> FFMPEG:
+        """
+            Add multiple files as a single input using the concat demuxer.
+
+            All the files are read by one demuxer one after the other, so they should share the
+            same codecs and parameters.
+
+            @param input_files: The files to concat, in order.
+            @param list_path: Where to write the concat list. When not given a temporary file
+                is used and removed after the command runs.
+            @param input_options: Extra options only for this input, added after the
+                extra_input_options.
+        """
+
+        if list_path is None:
+            file_descriptor, list_path = tempfile.mkstemp(prefix='ffmpeg_concat_', suffix='.txt')
+            os.close(file_descriptor)
+            self._temp_files.append(list_path)
+
+        with open(list_path, 'w', encoding='utf-8') as list_file:
+            for input_file in input_files:
+                input_file = os.path.abspath(input_file).replace("'", "'\\''")
+                list_file.write(f"file '{input_file}'\n")
+
+        self.cmd += self.extra_input_options
+        if input_options:
+            self.cmd += input_options
+        self.cmd += ['-f', 'concat', '-safe', '0', '-i', list_path]
+
+        self._input_files.append(list_path)
+        self._mark_input_on_gpu(list_path)
+        self._input_count += 1
+        return self
+
+    def add_silent_audio_input(self) -> FFMPEG:
+        """
+            Add a silent stereo audio track as an input, generated by lavfi.
+
+            The track never ends, so the output should be limited (ex: with -shortest).
+        """
+
+        self.cmd += ['-f', 'lavfi', '-i', f'anullsrc=r={self._bitrate}:cl=stereo']
         self._input_count += 1
         return self
 
@@ -324,7 +502,7 @@ class FFMPEG:
         self._add_settings()
         self._add_filter_complex()
 
-        self.cmd.extend([output_file])
+        self.cmd.append(output_file)
         self._output_added = True
         return self
 
@@ -340,58 +518,136 @@ class FFMPEG:
         SINGLE RUN COMMANDS
     """
 
-    def get_media_duration(self) -> float:
+    @property
+    def probe(self) -> PROBE:
         """
-            Get the media duration of the input file.
+            Get the PROBE instance that lives next to this ffmpeg binary.
         """
 
-        process = subprocess.Popen(self.cmd, stderr=subprocess.PIPE)
-        process.wait()
-        output = process.stderr.read().decode('utf-8')
-        process.stderr.close()
+        if self._probe is None:
+            directory, name = os.path.split(self.ffmpeg_path)
+            self._probe = PROBE(os.path.join(directory, name.replace('ffmpeg', 'ffprobe')))
 
-        logger.debug(f"Output from 'get_media_duration': {output}")
+        return self._probe
 
-        pattern = r'Duration: (\d{2}):(\d{2}):(\d{2}.\d{2})'
-        matches = re.search(pattern, output).groups()
+    def _last_input_file(self) -> str:
+        """
+            Get the last input file added.
+        """
 
-        hours = float(matches[0])
-        minutes = float(matches[1])
-        seconds = float(matches[2])
+        if not self._input_files:
+            raise Exception('Input file not added')
 
-        return normalize_float((hours * 60) * 60 + minutes * 60 + seconds)
+        return self._input_files[-1]
 
-    def get_media_width_height(self) -> Tuple[int, int]:
+    def get_media_duration(self) -> float:
         """
             Get the media duration of the input file.
         """
 
-        process = subprocess.Popen(self.cmd, stderr=subprocess.PIPE)
-        process.wait()
-        output = process.stderr.read().decode('utf-8')
-        process.stderr.close()
+        metadata = self.probe.get_metadata(self._last_input_file())
 
-        logger.debug(f"Output from 'get_media_width_height': {output}")
+        logger.debug(f"Output from 'get_media_duration': {metadata}")
 
-        pattern = r'Video:.*, (\d{3,5})x(\d{3,5})'
-        matches = re.search(pattern, output).groups()
+        if metadata['duration'] is None:
+            raise Exception(f'Could not get the duration of {self._last_input_file()}')
 
-        height = int(matches[1])
-        width = int(matches[0])
+        return normalize_float(metadata['duration'])
+
+    def get_media_width_height(self) -> Tuple[int, int]:
+        """
+            Get the media width and height of the input file.
+        """
+
+        width, height = self.probe.get_media_width_height(self._last_input_file())
+
+        logger.debug(f"Output from 'get_media_width_height': {width}x{height}")
 
         return width, height
 
+    """
+        GPU FRAMES MANAGEMENT
+    """
+
+    def _mark_input_on_gpu(self, input_file: str) -> None:
+        """
+            Mark the video of the input being added as GPU resident, the hwaccel input options
+            make ffmpeg decode it straight into GPU memory.
+
+            Images have no hardware decoder so they are always decoded to system memory.
+        """
+
+        if self._use_gpu and not input_file.lower().endswith(_IMAGE_EXTENSIONS):
+            self._gpu_streams.update({f'{self._input_count}', f'{self._input_count}:v'})
+
+    def _follow_residency(self, input: Input, output: Output) -> None:
+        """
+            The output of a filter lives in the same memory as its input.
+        """
+
+        if str(input) in self._gpu_streams:
+            self._gpu_streams.add(str(output))
+        else:
+            self._gpu_streams.discard(str(output))
+
+    def _transfer_label(self, input: Input, suffix: str) -> Output:
+        """
+            Create a unique label for a stream transferred between system and GPU memory.
+        """
+
+        self._transfer_count += 1
+        return f"{str(input).replace(':', '_')}_{suffix}_{self._transfer_count}"
+
+    def _download_from_gpu(self, input: Input) -> Input:
+        """
+            Bring a GPU resident stream to system memory so a CPU only filter can use it.
+
+            The stream stays in system memory until a GPU filter needs it again, so a run of
+            CPU filters only pays for one transfer.
+        """
+
+        if str(input) not in self._gpu_streams:
+            return input
+
+        output = self._transfer_label(input, 'cpu')
+        self._add_filter('hwdownload,format=nv12', (input,), (output,))
+        return output
+
+    def _upload_to_gpu(self, input: Input) -> Input:
+        """
+            Send a system memory stream to the GPU so a CUDA filter can use it.
+
+            It is uploaded as NV12, like the streams decoded on the GPU, so the CUDA filters
+            always get matching formats.
+        """
+
+        if not self._use_gpu or str(input) in self._gpu_streams:
+            return input
+
+        output = self._transfer_label(input, 'gpu')
+        self._add_filter('format=nv12,hwupload_cuda', (input,), (output,))
+        self._gpu_streams.add(output)
+        return output
+
     """
         FILTERS COMMANDS
     """
 
+    def _add_filter(self, kind: str, inputs: Tuple[Input, ...], outputs: Tuple[Output, ...],
+                    params: str = '') -> FFMPEG:
+        """
+            Add a filter to the filter complex, it is only formatted when the command is compiled.
+        """
+
+        self.filter_complex.append(FilterOp(kind, inputs, outputs, params))
+        return self
+
     def add_filter_complex(self, filter_complex: str) -> FFMPEG:
         """
             Add a custom filter complex.
         """
 
-        self.filter_complex.append(filter_complex)
-        return self
+        return self._add_filter('', (), (), filter_complex)
 
     @RoundFloats()
     def pad_equally(self, input: Input, width: Dimension, height: Dimension, color: str,
@@ -400,10 +656,13 @@ class FFMPEG:
             Pad the media to a given width and height keeping the media centered.
         """
 
-        self.filter_complex.append(
-            f"[{input}]pad='{width}':'{height}':'(ow-iw)/2':'(oh-ih)/2':"
-            f"color='{color}'[{output}];"
+        input = self._download_from_gpu(input)
+
+        self._add_filter(
+            'pad', (input,), (output,),
+            f"'{width}':'{height}':'(ow-iw)/2':'(oh-ih)/2':color='{color}'"
         )
+        self._follow_residency(input, output)
         return self
 
     @RoundFloats()
@@ -413,9 +672,10 @@ class FFMPEG:
             Crop the media to a given width and height.
         """
 
-        self.filter_complex.append(
-            f"[{input}]crop='{width}':'{height}':'{x}':'{y}'[{output}];"
-        )
+        input = self._download_from_gpu(input)
+
+        self._add_filter('crop', (input,), (output,), f"'{width}':'{height}':'{x}':'{y}'")
+        self._follow_residency(input, output)
         return self
 
     @RoundFloats()
@@ -424,18 +684,30 @@ class FFMPEG:
             Crop the media to a given width and height from the center.
         """
 
-        self.filter_complex.append(
-            f"[{input}]crop='{width}':'{height}':'0':'ih/2-{width}/2'[{output}];"
-        )
+        input = self._download_from_gpu(input)
+
+        self._add_filter('crop', (input,), (output,), f"'{width}':'{height}':'0':'ih/2-{width}/2'")
+        self._follow_residency(input, output)
         return self
 
     @RoundFloats()
-    def scale(self, input: Input, width: Dimension, height: Dimension, output: Output) -> FFMPEG:
+    def scale(self, input: Input, width: Dimension, height: Dimension, output: Output,
+              interp_algo: Optional[str] = None) -> FFMPEG:
         """
             Scale the media to a given width and height.
+
+            @param interp_algo: scale_cuda interpolation algorithm (nearest, bilinear, bicubic,
+                lanczos), uses ffmpeg's default when not given.
         """
 
-        self.filter_complex.append(f"[{input}]scale_cuda='{width}':'{height}'[{output}];")
+        input = self._upload_to_gpu(input)
+
+        params = f"'{width}':'{height}'"
+        if interp_algo:
+            params += f":interp_algo={interp_algo}"
+
+        self._add_filter('scale_cuda', (input,), (output,), params)
+        self._gpu_streams.add(str(output))
         return self
 
     @RoundFloats()
@@ -444,11 +716,15 @@ class FFMPEG:
             Make a round mask for the media.
         """
 
-        self.filter_complex.append(
-            f"[{input}]trim=end_frame=1,"
-            f"geq='st(3,pow(X-(W/2),2)+pow(Y-(H/2),2));if(lte(ld(3),pow(min(W/2,H/2),2)),255,"
-            f"0)':128:128,setpts=N/FRAME_RATE/TB[{output}]; "
+        input = self._download_from_gpu(input)
+
+        self._add_filter(
+            "trim=end_frame=1,"
+            "geq='st(3,pow(X-(W/2),2)+pow(Y-(H/2),2));if(lte(ld(3),pow(min(W/2,H/2),2)),255,"
+            "0)':128:128,setpts",
+            (input,), (output,), 'N/FRAME_RATE/TB'
         )
+        self._follow_residency(input, output)
         return self
 
     @RoundFloats()
@@ -457,7 +733,11 @@ class FFMPEG:
             Merge a mask with the media.
         """
 
-        self.filter_complex.append(f"[{input}][{mask}]alphamerge[{output}];")
+        input = self._download_from_gpu(input)
+        mask = self._download_from_gpu(mask)
+
+        self._add_filter('alphamerge', (input, mask), (output,))
+        self._follow_residency(input, output)
         return self
 
     def split_stream(self, input: Input, output_1: Output, output_2: Output) -> FFMPEG:
@@ -465,7 +745,23 @@ class FFMPEG:
             Split the media into two streams.
         """
 
-        self.filter_complex.append(f"[{input}]split=[{output_1}][{output_2}];")
+        self._add_filter('split', (input,), (output_1, output_2))
+        self._follow_residency(input, output_1)
+        self._follow_residency(input, output_2)
+        return self
+
+    def upload_overlay(self, input: Input, output: Output) -> FFMPEG:
+        """
+            Upload an overlay to the GPU in NV12, the format the CUDA decoder gives the main
+            stream, so it can be used by overlay_cuda. The alpha channel is dropped since
+            overlay_cuda only takes a NV12 overlay on a NV12 main stream.
+
+            Uploading once in the graph means each overlay frame crosses to the GPU only once
+            instead of ffmpeg converting it for every output frame.
+        """
+
+        self._add_filter('format=nv12,hwupload_cuda', (input,), (output,))
+        self._gpu_streams.add(str(output))
         return self
 
     @RoundFloats()
@@ -475,9 +771,14 @@ class FFMPEG:
             Overlay the overlay_item on the background_item.
         """
 
-        self.filter_complex.append(
-            f"[{background}][{overlay}]overlay_cuda='{x}':'{y}'[{output}];"
-        )
+        background = self._upload_to_gpu(background)
+        if self._use_gpu and str(overlay) not in self._gpu_streams:
+            overlay_gpu = self._transfer_label(overlay, 'gpu')
+            self.upload_overlay(overlay, overlay_gpu)
+            overlay = overlay_gpu
+
+        self._add_filter('overlay_cuda', (background, overlay), (output,), f"'{x}':'{y}'")
+        self._gpu_streams.add(str(output))
         return self
 
     @RoundFloats()
@@ -486,15 +787,18 @@ class FFMPEG:
         """
             Draw text on the media.
         """
+
+        input = self._download_from_gpu(input)
         font_file = normalize_font_path(font_file)
         font_file = f"fontfile='{font_file}':"
 
         text = fix_ffmpeg_text(text)
 
-        self.filter_complex.append(
-            f"[{input}]drawtext={font_file}text='{text}':fontcolor='{font_color}':"
-            f"fontsize='{font_size}':x='{x}':y='{y}'[{output}];"
+        self._add_filter(
+            'drawtext', (input,), (output,),
+            f"{font_file}text='{text}':fontcolor='{font_color}':fontsize='{font_size}':x='{x}':y='{y}'"
         )
+        self._follow_residency(input, output)
         return self
 
     @RoundFloats()
@@ -512,7 +816,10 @@ class FFMPEG:
             @param output:
             @return:
         """
-        self.filter_complex.append(f'[{input}]drawbox=x={x}:y={y}:color={color}:t=fill:w={width}:h={height}[{output}];')
+        input = self._download_from_gpu(input)
+
+        self._add_filter('drawbox', (input,), (output,), f'x={x}:y={y}:color={color}:t=fill:w={width}:h={height}')
+        self._follow_residency(input, output)
 
         return self
 
@@ -523,7 +830,8 @@ class FFMPEG:
         """
         speed = duration / 60
 
-        self.filter_complex.append(f"[{input}]setpts='{speed}*PTS'[{output}];")
+        self._add_filter('setpts', (input,), (output,), f"'{speed}*PTS'")
+        self._follow_residency(input, output)
         return self
 
     def aspect_ratio(self, input: Input, aspect_ratio: str, output: Output) -> FFMPEG:
@@ -538,9 +846,8 @@ class FFMPEG:
         if '/' not in aspect_ratio:
             warnings.warn(f'The aspect ratio {aspect_ratio} might not be valid.')
 
-        self.filter_complex.append(
-            f"[{input}]setdar={aspect_ratio}[{output}];"
-        )
+        self._add_filter('setdar', (input,), (output,), aspect_ratio)
+        self._follow_residency(input, output)
         return self
 
     @RoundFloats()
@@ -553,9 +860,8 @@ class FFMPEG:
             @param output:
         """
 
-        self.filter_complex.append(
-            f"[{input}]tpad=stop_mode=clone:stop_duration={duration}[{output}];"
-        )
+        self._add_filter('tpad', (input,), (output,), f'stop_mode=clone:stop_duration={duration}')
+        self._follow_residency(input, output)
         return self
 
     def volume(self, input: Input, volume: Volume, output: str) -> FFMPEG:
@@ -563,53 +869,63 @@ class FFMPEG:
             Set the volume of the media.
         """
 
-        self.filter_complex.append(f"[{input}]volume={volume}[{output}];")
+        self._add_filter('volume', (input,), (output,), f'{volume}')
         return self
 
     def concat(self, input: [(Input, Input)], output_video: str = None, output_audio: str = None) -> FFMPEG:
         """
             Concat media
         """
-        filter = ""
+        inputs = []
         for i in input:
             if output_video:
-                filter += f"[{i[0]}]"
+                inputs.append(i[0])
             if output_audio:
-                filter += f"[{i[1]}]"
-
-        filter += f"concat=n={len(input)}:"
+                inputs.append(i[1])
 
-        if output_audio and output_audio:
-            filter += f"v=1:a=1[{output_video}][{output_audio}];"
-        elif output_video:
-            filter += f"v=1[{output_video}];"
-        elif output_audio:
-            filter += f"a=1[{output_audio}];"
+        outputs = tuple(output for output in (output_video, output_audio) if output)
+        params = f"n={len(input)}:v={1 if output_video else 0}:a={1 if output_audio else 0}"
 
-        self.filter_complex.append(filter)
+        self._add_filter('concat', tuple(inputs), outputs, params)
+        if output_video:
+            if all(str(i[0]) in self._gpu_streams for i in input):
+                self._gpu_streams.add(output_video)
+            else:
+                self._gpu_streams.discard(output_video)
         return self
 
     def amix(self, item_1: Input, item_2: Input, output: Output) -> FFMPEG:
         """
             Mix the media.
         """
-        self.filter_complex.append(f"[{item_1}][{item_2}]amix=2[{output}];")
+        self._add_filter('amix', (item_1, item_2), (output,), '2')
         return self
 
-    def create_silent_audio_stream(self, output: Output, duration: int) -> FFMPEG:
+    def create_silent_audio_stream(self, duration: int) -> Output:
         """
+            Get a silent audio stream with the given duration.
+
+            Every stream gets its own anullsrc, they are generated as they are read so a concat
+            consuming them one after the other doesn't buffer any of them.
+
+            @param duration: Duration in seconds.
+            @return: The label of the silent stream.
         """
-        self.filter_complex.append(
-            f"anullsrc=channel_layout=stereo:sample_rate={self._bitrate}:d={duration}[{output}];"
+
+        self._silent_audio_count += 1
+        output = f"silent_{self._silent_audio_count}"
+        self._add_filter(
+            'anullsrc', (), (output,), f"channel_layout=stereo:sample_rate={self._bitrate}:d={duration}"
         )
-        return self
+
+        return output
 
     def aresample(self, input: Input, output: Output) -> FFMPEG:
         """
             Resample the media.
         """
 
-        self.filter_complex.append(f"[{input}]aresample={self.bitrate}[{output}];")
+        self._add_filter('aresample', (input,), (output,), f'{self.bitrate}')
         return self
 
     """
@@ -630,40 +946,173 @@ class FFMPEG:
             @return:
         """
         last_filter = self.filter_complex[-1]
-        output = re.search('(\[\w*];)', last_filter).groups()[0]
-        last_filter = last_filter.replace(output, '')
+        enable = f"enable='between(t,{start},{end})'"
+
+        if not last_filter.kind:
+            # Custom filter complex, the output has to be found in the text
+            output = _OUTPUT_TAG_RE.search(last_filter.params).groups()[0]
+            params = f"{last_filter.params.replace(output, '')}:{enable}{output}"
+        elif last_filter.params:
+            params = f"{last_filter.params}:{enable}"
+        else:
+            params = enable
 
-        self.filter_complex[-1] = f"{last_filter}:enable='between(t,{start},{end})'{output}"
+        self.filter_complex[-1] = last_filter._replace(params=params)
         return self
 
     def map(self, input: Input) -> FFMPEG:
         """
-            Map the media.
+            Map the media, filter outputs by their label and input streams (ex: 0:a) as they are.
         """
 
-        self.maps.extend(['-map', f'[{input}]'])
+        input = str(input)
+        self.maps.extend(['-map', input if _INPUT_STREAM_RE.match(input) else f'[{input}]'])
         return self
 
     """
         FILTERS COMMANDS END
     """
 
-    def run(self) -> FFMPEG:
+    def _remove_temp_files(self) -> None:
         """
-            Run the compiled command.
+            Remove the temporary files created while building the command.
+        """
+
+        while self._temp_files:
+            try:
+                os.remove(self._temp_files.pop())
+            except OSError:
+                pass
+
+    def batch_encode(self, segments: List[str], output_file: str) -> FFMPEG:
+        """
+            Encode multiple segments into one output file with a single ffmpeg process.
+
+            Replaces running one command per segment, so the encoder (and CUDA context when
+            using the GPU) is only initialized once for the whole batch.
+
+            The current settings are used, call reset() first when the instance already built
+            another command.
+
+            @param segments: The segment files, in order.
+            @param output_file: The output file.
+        """
+
+        return self.add_concat_demuxer(segments).add_output(output_file).run()
+
+    def freeze(self) -> FrozenFFMPEG:
+        """
+            Freeze the compiled command into a template that can be ran for other files.
+
+            Build the command once using INPUT_PLACEHOLDER as the input file and
+            OUTPUT_PLACEHOLDER as the output file, then call run on the returned template
+            for each file, skipping rebuilding the whole command every time.
+
+            The template outlives this instance, so it can't use temporary files (ex: a concat
+            list added without a list_path), they are removed when this instance is reset.
+        """
+
+        if not self._output_added:
+            raise Exception('Output file not added')
+        if self._temp_files:
+            raise Exception('Commands using temporary files can not be frozen, give them a path instead')
+
+        return FrozenFFMPEG(self.cmd, self._debug)
+
+    async def run_async(self) -> FFMPEG:
+        """
+            Run the compiled command without blocking the event loop, so multiple commands
+            can run at the same time.
         """
 
         if not self._output_added:
             raise Exception('Output file not added')
-        process = subprocess.Popen(self.cmd, stdout=sys.stdout, stderr=sys.stderr)
-        process.wait()
+        # In debug mode ffmpeg writes straight to our terminal, otherwise its stdout is
+        # discarded and only stderr is kept for the error message
+        stdout_target = None if self._debug else asyncio.subprocess.DEVNULL
+        stderr_target = None if self._debug else asyncio.subprocess.PIPE
+
+        try:
+            # ffmpeg switches a terminal stdin to raw mode and reads keys from it, with several
+            # commands running at once they would fight over it and could leave echo off
+            process = await asyncio.create_subprocess_exec(
+                *self.cmd, stdin=asyncio.subprocess.DEVNULL, stdout=stdout_target, stderr=stderr_target
+            )
+            stdout, stderr = await process.communicate()
+        finally:
+            self._remove_temp_files()
 
         if process.returncode != 0:
             raise RuntimeError(
                 f'ffmpeg exited with code {process.returncode}\n'
                 f'{self.cmd}\n'
-                f"Stdout: {process.stdout.read().decode('utf-8') if process.stdout else None}\n"
-                f"Stdout: {process.stderr.read().decode('utf-8') if process.stderr else None}\n"
+                f"Stdout: {stdout.decode('utf-8', errors='replace') if stdout else None}\n"
+                f"Stderr: {stderr.decode('utf-8', errors='replace') if stderr else None}\n"
+            )
+
+        return self
+
+    def run(self) -> FFMPEG:
+        """
+            Run the compiled command.
+        """
+
+        return asyncio.run(self.run_async())
+
+    @staticmethod
+    async def run_all_async(jobs: List[FFMPEG], max_concurrency: Optional[int] = None) -> List[FFMPEG]:
+        """
+            Run multiple compiled commands at the same time.
+
+            @param jobs: The FFMPEG instances to run, each with its output added.
+            @param max_concurrency: Maximum commands running at once, defaults to the cpu count.
+        """
+
+        semaphore = asyncio.Semaphore(max_concurrency or os.cpu_count() or 1)
+
+        async def run_job(job: FFMPEG) -> FFMPEG:
+            async with semaphore:
+                return await job.run_async()
+
+        return list(await asyncio.gather(*(run_job(job) for job in jobs)))
+
+
+class FrozenFFMPEG:
+    """
+        A compiled FFMPEG command where only the input and output files change between runs.
+    """
+
+    def __init__(self, cmd: List[str], debug: bool = False):
+        self.cmd = list(cmd)
+
+        self._debug = debug
+
+    def compile(self, input_file: str, output_file: str) -> List[str]:
+        """
+            Get the command for the given input and output files.
+        """
+
+        return [
+            arg.replace(INPUT_PLACEHOLDER, input_file).replace(OUTPUT_PLACEHOLDER, output_file)
+            for arg in self.cmd
+        ]
+
+    def run(self, input_file: str, output_file: str) -> FrozenFFMPEG:
+        """
+            Run the command for the given input and output files.
+        """
+
+        cmd = self.compile(input_file, output_file)
+
+        stdout_target = None if self._debug else subprocess.DEVNULL
+        stderr_target = None if self._debug else subprocess.PIPE
+        process = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=stdout_target, stderr=stderr_target)
+
+        if process.returncode != 0:
+            raise RuntimeError(
+                f'ffmpeg exited with code {process.returncode}\n'
+                f'{cmd}\n'
+                f"Stderr: {process.stderr.decode('utf-8', errors='replace') if process.stderr else None}\n"
             )
 
         return self
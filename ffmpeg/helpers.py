@@ -14,6 +14,8 @@ from typing import Tuple
 
 # Local Imports
 
+_FFMPEG_TEXT_TABLE = str.maketrans({':': r'\:', "'": None})
+
 
 @lru_cache(maxsize=4)
 def normalize_font_path(font_path: str) -> str:
@@ -50,20 +52,24 @@ def fit_text_to_screen(text: str, max_letters: int) -> list:
 
     text_words = text.split(' ')
     lines: list = []
-    current_phrase = ''
+    current_words: list = []
+    current_length = 0
 
     for word in text_words:
-        if len(current_phrase) + len(word) <= max_letters:
-            if len(current_phrase) == 0:
-                current_phrase = word
+        if current_length + len(word) <= max_letters:
+            if current_length == 0:
+                current_words = [word]
+                current_length = len(word)
                 continue
-            current_phrase += f' {word}'
+            current_words.append(word)
+            current_length += len(word) + 1  # Counting the space between words
         else:
-            lines.append(current_phrase)
-            current_phrase = word
+            lines.append(' '.join(current_words))
+            current_words = [word]
+            current_length = len(word)
 
-    if len(current_phrase) != 0:
-        lines.append(current_phrase)
+    if current_length != 0:
+        lines.append(' '.join(current_words))
 
     return lines
 
@@ -72,7 +78,5 @@ def fix_ffmpeg_text(text: str) -> str:
     """
         Escapes chars that ffmpeg might interpret as commands
     """
-    text = text.replace(':', r'\:')
-    text = text.replace("'", r"")
 
-    return text
\ No newline at end of file
+    return text.translate(_FFMPEG_TEXT_TABLE)
\ No newline at end of file
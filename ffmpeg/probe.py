@@ -9,6 +9,12 @@
 # Built-In Imports
 from __future__ import annotations
 
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
 # 3rd-Party Imports
 import subprocess
 
@@ -41,15 +47,12 @@ class PROBE:
         """
 
         process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE)
-        process.wait()
+        output, _ = process.communicate()
 
         if process.returncode != 0:
             raise Exception(f'probe exited with code {process.returncode}')
 
-        output = process.stdout.read().decode('utf-8')
-        process.stdout.close()
-
-        return output
+        return output.decode('utf-8')
 
     def reset(self) -> PROBE:
         """
@@ -61,26 +64,142 @@ class PROBE:
 
         return self
 
-    def get_media_duration(self, input_file: str) -> int:
+    def _probe_stream_info(self, input_file: str) -> str:
         """
-            Get the media duration of the input file.
+            Run ffprobe for the first video stream and the container info of the input file
+            and return the raw json output.
         """
 
         self.cmd.extend(
             [
                 '-v', 'error',
-                '-show_entries',
-                'format=duration',
-                '-of',
-                'default=noprint_wrappers=1:nokey=1',
+                '-select_streams', 'v:0',
+                '-show_entries', 'stream=width,height,codec_name,r_frame_rate,duration',
+                '-show_entries', 'format=duration',
+                '-of', 'json',
                 input_file
             ]
         )
 
-        process = self._run()
-        length = process.strip()
-        length = int(round(float(length), 0))
+        output = self._run()
 
         self.reset()
 
-        return length
+        return output
+
+    def get_stream_info(self, input_file: str) -> dict:
+        """
+            Get the first video stream and the container info of the input file.
+
+            Results are cached per file, modification time and size so probing the same
+            unchanged file again does not spawn ffprobe. Inputs that aren't local files
+            (ex: URLs or devices) are probed every time.
+        """
+
+        try:
+            stat = os.stat(input_file)
+        except OSError:
+            # A new PROBE so concurrent callers never share a command
+            output = PROBE(self.probe_path)._probe_stream_info(input_file)
+        else:
+            output = _probe_stream_info_cached(self.probe_path, input_file, stat.st_mtime_ns, stat.st_size)
+
+        return json.loads(output)
+
+    def get_metadata(self, input_file: str) -> dict:
+        """
+            Get the duration, width, height, fps and codec of the input file with a single
+            ffprobe run.
+
+            Values that ffprobe couldn't find are None.
+        """
+
+        info = self.get_stream_info(input_file)
+        stream = (info.get('streams') or [{}])[0]
+
+        duration = info.get('format', {}).get('duration') or stream.get('duration')
+
+        fps = None
+        if stream.get('r_frame_rate'):
+            numerator, _, denominator = stream['r_frame_rate'].partition('/')
+            if float(denominator or 1):
+                fps = float(numerator) / float(denominator or 1)
+
+        return {
+            'duration': float(duration) if duration is not None else None,
+            'width': int(stream['width']) if 'width' in stream else None,
+            'height': int(stream['height']) if 'height' in stream else None,
+            'fps': fps,
+            'codec': stream.get('codec_name'),
+        }
+
+    def get_media_duration(self, input_file: str) -> int:
+        """
+            Get the media duration of the input file.
+        """
+
+        duration = self.get_metadata(input_file)['duration']
+        if duration is None:
+            raise Exception(f'Could not get the duration of {input_file}')
+
+        return int(round(duration, 0))
+
+    def _get_metadata_or_none(self, input_file: str) -> Optional[dict]:
+        """
+            Get the metadata of the input file, None if it can't be probed.
+        """
+
+        try:
+            return self.get_metadata(input_file)
+        except Exception:
+            return None
+
+    def get_metadatas(self, input_files: List[str]) -> Dict[str, Optional[dict]]:
+        """
+            Get the metadata of multiple input files, probing them concurrently.
+
+            Files that can't be probed (ex: broken recordings) get None instead of failing
+            the whole batch. The returned dict keeps the order of the input files.
+        """
+
+        max_workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            metadatas = executor.map(self._get_metadata_or_none, input_files)
+
+            return dict(zip(input_files, metadatas))
+
+    def get_media_durations(self, input_files: List[str]) -> Dict[str, Optional[int]]:
+        """
+            Get the media duration of multiple input files, probing them concurrently.
+
+            Files that can't be probed or have no duration get None.
+        """
+
+        return {
+            input_file: int(round(metadata['duration'], 0))
+            if metadata and metadata['duration'] is not None else None
+            for input_file, metadata in self.get_metadatas(input_files).items()
+        }
+
+    def get_media_width_height(self, input_file: str) -> Tuple[int, int]:
+        """
+            Get the width and height of the first video stream of the input file.
+        """
+
+        metadata = self.get_metadata(input_file)
+        if metadata['width'] is None or metadata['height'] is None:
+            raise Exception(f'No video stream found in {input_file}')
+
+        return metadata['width'], metadata['height']
+
+
+@lru_cache(maxsize=512)
+def _probe_stream_info_cached(probe_path: str, input_file: str, mtime_ns: int, size: int) -> str:
+    """
+        Cached ffprobe run, the mtime and size are only part of the key so a modified file
+        gets probed again.
+
+        A new PROBE is used for every run so concurrent callers never share a command.
+    """
+
+    return PROBE(probe_path)._probe_stream_info(input_file)
@@ -7,6 +7,7 @@
 #  Github: https://github.com/DEADSEC-SECURITY
 
 # Built-In Imports
+from collections import namedtuple
 from typing import TypeVar, NewType, Union
 
 # 3rd-Party Imports
@@ -21,3 +22,7 @@ Position = NewType('Position', Union[str, int, float])
 Seconds = TypeVar('Seconds', str, int, float)
 Volume = TypeVar('Volume', str, int)
 Size = TypeVar('Size', str, int, float)
+
+# A filter of the filter complex, kept unformatted until the command is compiled.
+# "kind" is the filter name (it might be preceded by a chain of filters) and "params" its options.
+FilterOp = namedtuple('FilterOp', 'kind inputs outputs params')
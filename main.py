@@ -1,10 +1,13 @@
 import datetime
+import itertools
+import json
+import os
 import pathlib
-import subprocess
-import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from tqdm import tqdm
 from rich.console import Console
 from rich.table import Table
@@ -16,16 +19,95 @@ DEBUG = False
 
 LOCAL_DIR = pathlib.Path.cwd()
 INPUT_DIR = LOCAL_DIR.joinpath("test_input") if DEBUG else LOCAL_DIR.joinpath("input")
+PROBE_CACHE_FILE = LOCAL_DIR.joinpath("probe_cache.json")  # Probed metadata kept between runs
 
 PROBE = PROBE()
 
+# Size of the back camera picture in picture, 2/3 of 1080p and kept even for NVENC
+PIP_W = 1280
+PIP_H = 720
+
+GROUP_GAP = datetime.timedelta(hours=2)  # Clips closer than this to the previous one go in the same video
 FFMPEG_COMPILING_SPEED = 1.5  # Average speed FFMPEG compiles the videos with current settings
+NVENC_SESSIONS = 2  # Groups compiled at the same time, keep at or below the GPU's NVENC session limit
+
+# NVENC constant quality settings, the footage is already compressed by the dashcam so a faster
+# preset doesn't make a visible difference
+NVENC_PRESET = "p4"
+NVENC_OUTPUT_OPTIONS = [
+    "-tune", "hq", "-rc", "vbr", "-cq", "23", "-b:v", "0",
+    "-bf", "2", "-b_ref_mode", "middle", "-spatial_aq", "1"
+]
+# Options for every clip input, a slightly bigger queue than the default keeps the demuxers from stalling
+# each other while the inputs stay few and small
+CLIP_INPUT_OPTIONS = ["-thread_queue_size", "512", "-fflags", "+genpts"]
+# Moves the index to the start of the file so it can play before being fully downloaded. ffmpeg does it
+# with a second pass that rewrites the whole finished file, so it's off for videos watched locally
+FASTSTART = False
+MUXER_OUTPUT_OPTIONS = ["-avoid_negative_ts", "make_zero"] + (["-movflags", "+faststart"] if FASTSTART else [])
+
+# Codec the dashcam records with, clips in it can be joined without re-encoding
+COPY_CODEC = "h264"
+
+# Length of every clip in seconds, set it to the dashcam loop recording length (ex: 60) to skip
+# probing the files, they are then trusted to be the dashcam's own recordings. Leave it as None to
+# probe, which also skips broken files and re-encodes clips that can't be joined as they are
+CLIP_DURATION_SECONDS: Optional[int] = None
+
+
+_thread_local = threading.local()
+
+
+def get_ffmpeg() -> FFMPEG:
+    """
+    Each worker thread keeps one FFMPEG wrapper and reuses it for every group it compiles
+
+    :return:
+    """
+    ffmpeg = getattr(_thread_local, "ffmpeg", None)
+    if ffmpeg is None:
+        ffmpeg = FFMPEG(use_gpu=True)
+        ffmpeg.debug = DEBUG
+        _thread_local.ffmpeg = ffmpeg
+    return ffmpeg
 
 
 def datetime_from_file_name(file: pathlib.Path) -> datetime.datetime:
-    file_name_datetime_section = file.name.split(".")[0][:15]
-    datetime_ = datetime.datetime.strptime(file_name_datetime_section, "%Y%m%d_%H%M%S")
-    return datetime_
+    # File names start with the recording time as YYYYMMDD_HHMMSS
+    name = file.name
+    return datetime.datetime(
+        int(name[0:4]), int(name[4:6]), int(name[6:8]),
+        int(name[9:11]), int(name[11:13]), int(name[13:15])
+    )
+
+
+def probe_metadata(file: pathlib.Path) -> Optional[dict]:
+    try:
+        return PROBE.get_metadata(file.as_posix())
+    except Exception:
+        return None
+
+
+def _probe_cache_key(file: pathlib.Path) -> str:
+    # A file that gets replaced or modified changes its mtime or size, so it's probed again
+    stat = file.stat()
+    return f"{file}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def load_probe_cache() -> Dict[str, dict]:
+    try:
+        with PROBE_CACHE_FILE.open() as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    # Older caches only kept the duration, those files are probed again
+    return {key: metadata for key, metadata in cache.items() if isinstance(metadata, dict)}
+
+
+def save_probe_cache(cache: Dict[str, dict]):
+    with PROBE_CACHE_FILE.open("w") as f:
+        json.dump(cache, f)
 
 
 class VideoTypes(Enum):
@@ -40,20 +122,23 @@ class VideoViewPointType(Enum):
 
 @dataclass
 class Video:
-    ffmpeg: FFMPEG
     path: pathlib.Path
+    path_posix: str
     view_point: VideoViewPointType
     type_: VideoTypes
     duration_seconds: Optional[int]
-    ffmpeg_input_number: Input = 0
-    ffmpeg_video_stream: Input = "0:v"
-    ffmpeg_audio_stream: Input = "0:a"
+    metadata: Optional[dict]
 
-    def __init__(self, ffmpeg: FFMPEG, path: pathlib.Path):
-        self.ffmpeg = ffmpeg
+    def __init__(self, path: pathlib.Path, metadata: Optional[dict] = None, probed: bool = False):
+        """
+        :param metadata: The probed metadata of the clip
+        :param probed: The clip was already probed, a None metadata means the probe failed so it isn't retried
+        """
         self.path = path
+        self.path_posix = path.as_posix()
+        self.metadata = metadata
 
-        file_name = path.name.split(".")[0]
+        file_name = path.name.partition(".")[0]
         if "P" in file_name:
             self.type_ = VideoTypes.Parked
         else:
@@ -64,33 +149,57 @@ class Video:
         else:
             self.view_point = VideoViewPointType.Back
 
-        try:
-            self.duration_seconds = PROBE.get_media_duration(self.path.as_posix())
-        except Exception:
-            self.duration_seconds = None
+        if CLIP_DURATION_SECONDS is None and self.metadata is None and not probed:
+            self.metadata = probe_metadata(self.path)
 
-    def add_as_ffmpeg_input(self):
-        self.ffmpeg.add_input(self.path.as_posix())
-        self.ffmpeg_input_number = self.ffmpeg.current_input_index
-        self.ffmpeg_video_stream = f"{self.ffmpeg.current_input_index}:v"
-        self.ffmpeg_audio_stream = f"{self.ffmpeg.current_input_index}:a"
+        self.duration_seconds = CLIP_DURATION_SECONDS
+        if self.duration_seconds is None and self.metadata and self.metadata["duration"] is not None:
+            self.duration_seconds = int(round(self.metadata["duration"]))
 
-        if self.type_ == VideoTypes.Parked and self.view_point == VideoViewPointType.Front:
-            self.add_audio_stream()
+    @property
+    def needs_reencode(self) -> bool:
+        """
+        Checks if the clip has to be re-encoded to be joined with the others, instead of copied as it is.
+        Clips that weren't probed are trusted to be the dashcam's own recordings
+
+        :return:
+        """
+        return self.metadata is not None and self.metadata["codec"] != COPY_CODEC
+
+    @property
+    def resolution(self) -> Optional[Tuple[int, int]]:
+        """
+        The width and height of the clip, None if it wasn't probed
+
+        :return:
+        """
+        if self.metadata is None:
+            return None
+        return self.metadata["width"], self.metadata["height"]
 
-    def add_audio_stream(self):
+    @property
+    def concat_key(self) -> tuple:
         """
-        Adds a silent audio stream to the video, so it can be used in concat
+        Clips with the same key can be read one after the other by a single concat demuxer
 
         :return:
         """
-        self.ffmpeg_audio_stream = f"a_{self.ffmpeg_input_number}"
-        self.ffmpeg.create_silent_audio_stream(self.ffmpeg_audio_stream, self.duration_seconds)
+        return self.metadata and self.metadata["codec"], self.resolution, self.type_
+
+
+def can_stream_concat(videos: List[Video]) -> bool:
+    """
+    Checks if the clips can be read one after the other by the concat demuxer, they have to share the codec,
+    resolution and recording type (parked recordings have no audio)
+
+    :return:
+    """
+    return not any(video.needs_reencode for video in videos) and len({video.concat_key for video in videos}) == 1
 
 
 @dataclass
 class VideoGroup:
-    ffmpeg: FFMPEG
+    ffmpeg: Optional[FFMPEG]
     title: str
     start_time: datetime.datetime
     end_time: datetime.datetime
@@ -108,12 +217,10 @@ class VideoGroup:
         self.back_videos = []
         self.final_video = None
 
+        # When not given, the worker thread's FFMPEG is used once the video is made
         self.ffmpeg = ffmpeg
-        if not ffmpeg:
-            self.ffmpeg = FFMPEG(use_gpu=True)
-
-        # Configure FFMPEG
-        self.ffmpeg.debug = DEBUG
+        if ffmpeg:
+            self.ffmpeg.debug = DEBUG
 
         for video in videos:
             self.add_video(video)
@@ -121,8 +228,8 @@ class VideoGroup:
         # Create title
         self.title = self.start_time.strftime("%d %b %Y %H-%M-%S")
 
-    def add_video(self, video: pathlib.Path):
-        video = Video(self.ffmpeg, video)
+    def add_video(self, video: pathlib.Path, metadata: Optional[dict] = None, probed: bool = False):
+        video = Video(video, metadata, probed)
 
         if video.duration_seconds is None:
             return
@@ -167,105 +274,188 @@ class VideoGroup:
             print("Skipping ... Already exists")
             return
 
+        if not self.front_videos and not self.back_videos:
+            print("Skipping ... No videos")
+            return
+
+        ffmpeg = self.ffmpeg or get_ffmpeg()
+
+        if not self.front_videos or not self.back_videos:
+            # Only one camera recorded, there is nothing to put in picture in picture
+            self.make_single_side_video(ffmpeg, self.front_videos or self.back_videos, final_output_file)
+            return
+
         front_and_back_videos = list(zip(self.front_videos, self.back_videos))
-        batches: List[Tuple[Video, Video]] = [front_and_back_videos[i:i + 4] for i in range(0, len(front_and_back_videos), 4)]
-
-        batch_files = []
-        for index, batch in enumerate(batches):
-            output_file = pathlib.Path(f"{self.title}_{index}.mp4")
-            batch_files.append(output_file)
-
-            self.ffmpeg.reset()
-
-            for front_video, back_video in batch:
-                front_video.add_as_ffmpeg_input()
-                back_video.add_as_ffmpeg_input()
-
-            self.ffmpeg.concat(
-                input=[(video.ffmpeg_video_stream, video.ffmpeg_audio_stream) for (video, _) in batch],
-                output_video="front_v",
-                output_audio="front_a"
-            ).concat(
-                input=[(video.ffmpeg_video_stream, video.ffmpeg_audio_stream) for (_, video) in batch],
-                output_video="back_v"
-            ).scale(
-                input="back_v",
-                width=1920 / 1.5,
-                height=1080 / 1.5,
-                output="back_v"
-            ).overlay(
-                background="front_v",
-                overlay="back_v",
-                x=0, y=0,
-                output="v"
-            ).map(
-                "v"
-            ).map(
-                "front_a"
-            ).add_output(output_file.as_posix())
-
-            if DEBUG:
-                print(self.ffmpeg)
-                input("PRESS ENTER TO RUN")
-
-            self.ffmpeg.run()
-
-        cmd = ["ffmpeg"]
-        for batch_file in batch_files:
-            cmd.extend(["-i", batch_file])
-
-        cmd.extend(["-filter_complex", f"concat=n={len(batch_files)}:v=1:a=1", "-c:v", "h264_nvenc", "-preset", "slow", "-qp", "20", "-c:a", "aac", "-b:a", "44100", final_output_file])
-        process = subprocess.Popen(cmd, stdout=sys.stdout, stderr=sys.stderr)
-        process.wait()
+        front_videos = [video for video, _ in front_and_back_videos]
+        back_videos = [video for _, video in front_and_back_videos]
+
+        # Everything is compiled in a single pass, straight into the final video
+        ffmpeg.reset()
+        ffmpeg.preset = NVENC_PRESET
+        ffmpeg.quality = None  # Quality is set by -cq
+        ffmpeg.extra_output_options.extend(NVENC_OUTPUT_OPTIONS)
+        ffmpeg.extra_output_options.extend(MUXER_OUTPUT_OPTIONS)
+
+        # Parked recordings have no audio, when all of them are parked a single silent track is used
+        # for the whole video instead of one silent stream per clip
+        all_fronts_parked = all(video.type_ == VideoTypes.Parked for video in front_videos)
+
+        front_video, front_audio = self.add_camera_input(ffmpeg, front_videos, "front", not all_fronts_parked)
+        back_video, _ = self.add_camera_input(ffmpeg, back_videos, "back", False)
+
+        if all_fronts_parked:
+            ffmpeg.add_silent_audio_input()
+            ffmpeg.extra_output_options.append("-shortest")
+            front_audio = f"{ffmpeg.current_input_index}:a"
+
+        ffmpeg.scale(
+            input=back_video,
+            width=PIP_W,
+            height=PIP_H,
+            output="back_v",
+            interp_algo="bicubic"
+        ).overlay(
+            background=front_video,
+            overlay="back_v",
+            x=0, y=0,
+            output="v"
+        ).map(
+            "v"
+        ).map(
+            front_audio
+        ).add_output(final_output_file.as_posix())
+
+        if DEBUG:
+            print(ffmpeg)
+            input("PRESS ENTER TO RUN")
+
+        ffmpeg.run()
 
         self.final_video = final_output_file
 
+    @staticmethod
+    def add_camera_input(
+            ffmpeg: FFMPEG, videos: List[Video], name: str, with_audio: bool
+    ) -> Tuple[Input, Optional[Input]]:
+        """
+        Adds the clips of one camera as a single stream. Each run of consecutive clips that share the codec,
+        resolution and recording type is read by one concat demuxer, so a long drive is a couple of inputs
+        instead of one decoder per clip, the runs are then joined by the concat filter
 
-def display_table(videos: List[VideoGroup]):
-    print(f"Total Videos: {len(videos)}")
-    table = Table()
+        :param name: Prefix of the filter outputs
+        :param with_audio: Also join the audio, parked runs get a silent stream
+        :return: The video and audio streams, the audio is None without audio
+        """
+        streams = []
+        for _, run in itertools.groupby(videos, key=lambda video: video.concat_key):
+            run = list(run)
+            ffmpeg.add_concat_demuxer([video.path_posix for video in run], input_options=CLIP_INPUT_OPTIONS)
+            index = ffmpeg.current_input_index
+
+            audio_stream = f"{index}:a"
+            if with_audio and run[0].type_ == VideoTypes.Parked:
+                # Parked recordings have no audio
+                audio_stream = ffmpeg.create_silent_audio_stream(sum(video.duration_seconds for video in run))
+            streams.append((f"{index}:v", audio_stream))
+
+        if len(streams) == 1:
+            video_stream, audio_stream = streams[0]
+            return video_stream, (audio_stream if with_audio else None)
+
+        ffmpeg.concat(
+            input=streams,
+            output_video=f"{name}_v",
+            output_audio=f"{name}_a" if with_audio else None
+        )
+        return f"{name}_v", (f"{name}_a" if with_audio else None)
 
-    # Add columns
-    columns = ["Start Time", "End Time", "Total Videos", "Total Front Videos", "Total Back Videos", "Total Minutes",
-               "Has Missing Videos", "Compiling Time", "Final Video"]
-    for column in columns:
-        table.add_column(column)
+    def make_single_side_video(self, ffmpeg: FFMPEG, videos: List[Video], final_output_file: pathlib.Path):
+        """
+        Joins the clips of a single camera, they are copied as they are when they share the codec,
+        resolution and recording type, otherwise they are re-encoded
+
+        :return:
+        """
+        ffmpeg.reset()
+
+        if can_stream_concat(videos):
+            ffmpeg.stream_copy()
+            ffmpeg.extra_output_options.extend(MUXER_OUTPUT_OPTIONS)
+            ffmpeg.add_concat_demuxer([video.path_posix for video in videos], input_options=CLIP_INPUT_OPTIONS)
+        else:
+            ffmpeg.preset = NVENC_PRESET
+            ffmpeg.quality = None  # Quality is set by -cq
+            ffmpeg.extra_output_options.extend(NVENC_OUTPUT_OPTIONS)
+            ffmpeg.extra_output_options.extend(MUXER_OUTPUT_OPTIONS)
+
+            # Only the front camera records audio
+            with_audio = videos[0].view_point == VideoViewPointType.Front
+            video_stream, audio_stream = self.add_camera_input(ffmpeg, videos, "camera", with_audio)
+            ffmpeg.map(video_stream)
+            if audio_stream:
+                ffmpeg.map(audio_stream)
+
+        ffmpeg.add_output(final_output_file.as_posix())
+
+        if DEBUG:
+            print(ffmpeg)
+            input("PRESS ENTER TO RUN")
+
+        ffmpeg.run()
+
+        self.final_video = final_output_file
+
+
+TABLE_COLUMNS = ["Start Time", "End Time", "Total Videos", "Total Front Videos", "Total Back Videos",
+                 "Total Minutes", "Has Missing Videos", "Compiling Time", "Final Video"]
+
+
+def build_rows(videos: List[VideoGroup]) -> Tuple[List[List[str]], List[str]]:
+    """
+    Builds the table rows once, the final video column is left out since it changes while compiling
 
-    totals = {
-        "front_videos": 0,
-        "back_videos": 0,
-        "minutes": 0
-    }
+    :return: The row of each group and the totals row
+    """
+    rows = []
     for video in videos:
         front_videos = len(video.front_videos)
         back_videos = len(video.back_videos)
-        minutes = video.total_seconds // 60
-
-        # Add to totals
-        totals["front_videos"] += front_videos
-        totals["back_videos"] += back_videos
-        totals["minutes"] += minutes
-
-        # Add row
-        table.add_row(
+        rows.append([
             str(video.start_time), str(video.end_time),
             str(front_videos + back_videos),
             str(front_videos), str(back_videos),
-            str(minutes),
+            str(video.total_seconds // 60),
             str(video.has_missing_pair),
-            str(datetime.timedelta(minutes=len(video.front_videos))),
-            str(video.final_video)
-        )
+            str(datetime.timedelta(minutes=front_videos))
+        ])
+
+    total_front_videos = sum(len(video.front_videos) for video in videos)
+    total_back_videos = sum(len(video.back_videos) for video in videos)
+    totals = [
+        "", "Totals",
+        str(total_front_videos + total_back_videos),
+        str(total_front_videos), str(total_back_videos),
+        str(sum(video.total_seconds // 60 for video in videos)),
+        "Total Compiling Time", str(datetime.timedelta(minutes=total_front_videos / FFMPEG_COMPILING_SPEED)),
+    ]
+
+    return rows, totals
+
+
+def render_table(videos: List[VideoGroup], rows: List[List[str]], totals: List[str]):
+    print(f"Total Videos: {len(videos)}")
+    table = Table()
+
+    # Add columns
+    for column in TABLE_COLUMNS:
+        table.add_column(column)
+
+    for video, row in zip(videos, rows):
+        table.add_row(*row, str(video.final_video))
 
     # Add total row
     table.add_section()
-    table.add_row(
-        "", "Totals",
-        str(totals["front_videos"] + totals["back_videos"]),
-        str(totals["front_videos"]), str(totals["back_videos"]),
-        str(totals["minutes"]),
-        "Total Compiling Time", str(datetime.timedelta(minutes=totals["front_videos"] / FFMPEG_COMPILING_SPEED)),
-    )
+    table.add_row(*totals)
 
     console = Console()
     console.print(table)
@@ -274,25 +464,53 @@ def display_table(videos: List[VideoGroup]):
 def get_videos() -> List[VideoGroup]:
     videos: List[VideoGroup] = []
 
-    files = list(INPUT_DIR.iterdir())
-    for file in tqdm(files, desc="Loading Videos"):
-        file_datetime = datetime_from_file_name(file)
-
-        found_group = False
-        for video in videos:
-            # Check if the current file is within N time of the last video clip
-            if file_datetime - datetime.timedelta(hours=2) < video.end_time:
-                video.end_time = file_datetime
-                video.add_video(file)
-                found_group = True
-                break
-
-        if not found_group:
-            videos.append(VideoGroup(
+    # Sorted by recording time, so a file can only belong to the last group created
+    # Only the clips themselves, skips folders and anything else the dashcam or OS leaves around
+    with os.scandir(INPUT_DIR) as entries:
+        clips = [pathlib.Path(e.path) for e in entries if e.is_file() and e.name.lower().endswith(".mp4")]
+    files_datetimes = sorted((datetime_from_file_name(file), file) for file in clips)
+    files = [file for _, file in files_datetimes]
+
+    # Vantrue file names only have the start time, sequence and camera, everything else has to be probed
+    # unless the clip length is configured
+    metadatas: Dict[pathlib.Path, Optional[dict]] = {file: None for file in files}
+
+    if CLIP_DURATION_SECONDS is None:
+        probe_cache = load_probe_cache()
+        cache_keys = {file: _probe_cache_key(file) for file in files}
+        for file, key in cache_keys.items():
+            metadatas[file] = probe_cache.get(key)
+        files_to_probe = [file for file in files if metadatas[file] is None]
+
+        # Probing is mostly waiting on ffprobe, so all the files are probed at the same time
+        print(f"Probing {len(files_to_probe)} Videos")
+        probed = PROBE.get_metadatas([file.as_posix() for file in files_to_probe])
+        metadatas.update(zip(files_to_probe, probed.values()))
+
+        # Only the current files are kept, deleted or changed clips are dropped from the cache. Broken files
+        # aren't cached, so they're retried on the next run
+        new_probe_cache = {
+            cache_keys[file]: metadatas[file] for file in files
+            if metadatas[file] is not None and metadatas[file]["duration"] is not None
+        }
+        if new_probe_cache != probe_cache:
+            save_probe_cache(new_probe_cache)
+
+    for file_datetime, file in tqdm(files_datetimes, desc="Loading Videos"):
+        # Check if the current file is within N time of the last video clip
+        if videos and file_datetime - GROUP_GAP < videos[-1].end_time:
+            video = videos[-1]
+            video.end_time = file_datetime
+        else:
+            video = VideoGroup(
                 start_time=file_datetime,
                 end_time=file_datetime,
-                videos=[file]
-            ))
+                videos=[]
+            )
+            videos.append(video)
+
+        # Every file was probed or found in the cache, unless the clip length is configured
+        video.add_video(file, metadatas[file], probed=CLIP_DURATION_SECONDS is None)
 
     return videos
 
@@ -300,8 +518,15 @@ def get_videos() -> List[VideoGroup]:
 if __name__ == '__main__':
     vs = get_videos()
     # vs.sort(key=lambda x: x.total_real_minutes)
-    display_table(vs)
+    table_rows, table_totals = build_rows(vs)
+    render_table(vs, table_rows, table_totals)
     input("Press ENTER to start compiling media")
-    for v in tqdm(vs, desc="Processing Videos"):
-        v.make_video()
-        display_table(vs)
+
+    os.environ.setdefault("CUDA_DEVICE_MAX_CONNECTIONS", str(NVENC_SESSIONS))
+    # In debug mode every group waits on a prompt before running, so they go one at a time
+    with ThreadPoolExecutor(max_workers=1 if DEBUG else NVENC_SESSIONS) as executor:
+        futures = [executor.submit(v.make_video) for v in vs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing Videos"):
+            future.result()
+            # Only redrawn from the main thread, as each group completes
+            render_table(vs, table_rows, table_totals)